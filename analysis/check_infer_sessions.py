@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Check that the vectorized session inference in kv_reuse_analysis.py / kv_reuse_robustness.py
+matches the original per-row loop, on a hand-built frame and on a slice of the trace.
+Exits non-zero on the first mismatch.
+"""
+
+import argparse
+import pandas as pd
+import numpy as np
+
+from kv_reuse_common import DATA_PATH, load_trace, sort_by_timestamp
+from kv_reuse_analysis import SESSION_GAP_SEC, infer_sessions
+from kv_reuse_robustness import infer_sessions_by_gap
+
+GAPS = [900, 1800, 3600]
+
+
+def infer_sessions_loop(df: pd.DataFrame, gap_sec: int) -> np.ndarray:
+    """The original row-by-row session inference, kept as the reference."""
+    out = np.zeros(len(df), dtype=np.int64)
+    session_id = 0
+    prev_t = -np.inf
+    log_type_col = "Log Type" if "Log Type" in df.columns else None
+    for i in range(len(df)):
+        row = df.iloc[i]
+        t = row["Timestamp"]
+        log_type = row[log_type_col] if log_type_col else "Conversation log"
+        if log_type != "Conversation log":
+            session_id += 1
+            out[i] = session_id
+            prev_t = t
+            continue
+        if t - prev_t > gap_sec:
+            session_id += 1
+        out[i] = session_id
+        prev_t = t
+    return out
+
+
+def edge_case_frame() -> pd.DataFrame:
+    """Small trace covering the gap rule and non-conversation rows."""
+    rows = [
+        (0, "Conversation log"),
+        (100, "Conversation log"),        # within gap: same session
+        (200, "API log"),                 # non-conversation: own session
+        (300, "Conversation log"),        # within gap of the API row: joins the API row's session (loop semantics)
+        (400, "API log"),
+        (500, "API log"),                 # consecutive non-conversation rows: one session each
+        (10_000, "Conversation log"),     # beyond every gap: new session
+        (10_000, "Conversation log"),     # identical timestamp: same session
+        (11_000, "Conversation log"),     # splits at 900s, joins at 1800s / 3600s
+        (13_500, "Conversation log"),     # splits at 900s / 1800s, joins at 3600s
+    ]
+    df = pd.DataFrame(rows, columns=["Timestamp", "Log Type"])
+    df["Log Type"] = df["Log Type"].astype("category")
+    return df
+
+
+def check(df: pd.DataFrame, what: str) -> None:
+    by_gap = infer_sessions_by_gap(df, GAPS)
+    for gap_sec in GAPS:
+        expected = infer_sessions_loop(df, gap_sec)
+        if not np.array_equal(by_gap[gap_sec], expected):
+            raise SystemExit(f"{what}: infer_sessions_by_gap differs from the loop at gap={gap_sec}s")
+    if not np.array_equal(infer_sessions(df), infer_sessions_loop(df, SESSION_GAP_SEC)):
+        raise SystemExit(f"{what}: infer_sessions differs from the loop at gap={SESSION_GAP_SEC}s")
+    print(f"{what}: {len(df)} rows match for gaps {GAPS}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=30_000, help="trace rows to compare (0 skips the trace check)")
+    args = parser.parse_args()
+
+    df = edge_case_frame()
+    expected = np.array([1, 1, 2, 2, 3, 4, 5, 5, 6, 7])
+    if not np.array_equal(infer_sessions_loop(df, 900), expected):
+        raise SystemExit("edge cases: reference loop no longer gives the documented sessions")
+    check(df, "edge cases")
+
+    if args.rows and DATA_PATH.exists():
+        trace = load_trace()
+        trace["Timestamp"] = pd.to_numeric(trace["Timestamp"], errors="coerce")
+        trace = sort_by_timestamp(trace.dropna(subset=["Timestamp"]))
+        check(trace.head(args.rows).reset_index(drop=True), f"trace slice ({DATA_PATH.name})")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,28 +8,84 @@ import os
 import sys
 import pandas as pd
 import numpy as np
-from pathlib import Path
 
-# Paths
-REPO_ROOT = Path(__file__).resolve().parent.parent
-DATA_PATH = REPO_ROOT / "data" / "BurstGPT_1.csv"
-OUT_DIR = REPO_ROOT / "analysis" / "output"
+from kv_reuse_common import (
+    OUT_DIR, load_trace, non_conversation_mask, render_plots, session_table, sort_by_timestamp,
+)
+
 SESSION_GAP_SEC = 1800  # 30 min: gap above this starts a new session (for inferred sessions)
 
 
+def _draw_avg_turns_vs_time(ax, d):
+    # 1) Average #turns vs time (line plot) — use time_bin
+    ax.plot(d["days_bin"], d["by_bin"]["avg_turns"], linewidth=0.8, color="C0")
+    ax.set_xlabel("Time (days from start)")
+    ax.set_ylabel("Avg #turns per session")
+    ax.set_title("Average session depth over time (1-hour bins)")
+    ax.grid(True, alpha=0.3)
+
+
+def _draw_session_count_vs_time(ax, d):
+    # 2) Session count vs time
+    ax.fill_between(d["days_bin"], d["by_bin"]["session_count"], alpha=0.6, color="C1")
+    ax.set_xlabel("Time (days from start)")
+    ax.set_ylabel("Session count")
+    ax.set_title("Session count per 1-hour window")
+    ax.grid(True, alpha=0.3)
+
+
+def _draw_turns_histogram(ax, d):
+    # 3) Distribution of #turns (histogram)
+    n_turns = d["session_stats"]["n_turns"]
+    max_turns = min(int(n_turns.quantile(0.99)), 50)
+    # n_turns are small positive ints: count them directly instead of binning in ax.hist
+    counts = np.bincount(np.minimum(n_turns.to_numpy(), max_turns), minlength=max_turns + 1)
+    ax.bar(np.arange(1, max_turns + 1), counts[1:], width=1.0, align="center", edgecolor="black", alpha=0.7)
+    ax.set_xlabel("#turns per session")
+    ax.set_ylabel("Count")
+    ax.set_title("Distribution of session depth (#turns)")
+
+
+def _draw_turns_vs_hour_of_day(ax, d):
+    # 4) #turns vs hour of day (box plot)
+    ax.bxp(box_stats_by(d["session_stats"], "hour_int", "n_turns"))
+    ax.grid(True, alpha=0.3)
+    ax.set_xlabel("Hour of day (from trace start)")
+    ax.set_ylabel("#turns per session")
+    ax.set_title("Session depth by hour of day")
+
+
+def _draw_avg_turns_by_hour(ax, d):
+    # 5) Bar: avg turns by hour of day (clearer for report)
+    ax.bar(d["by_hour"]["hour"], d["by_hour"]["avg_turns"], width=0.7, color="steelblue", edgecolor="navy", alpha=0.8)
+    ax.set_xlabel("Hour of day")
+    ax.set_ylabel("Avg #turns per session")
+    ax.set_title("Average session depth by hour of day")
+
+
+# (output filename, figsize, draw function)
+PLOTS = [
+    ("avg_turns_vs_time.png", (10, 4), _draw_avg_turns_vs_time),
+    ("session_count_vs_time.png", (10, 4), _draw_session_count_vs_time),
+    ("turns_histogram.png", (8, 4), _draw_turns_histogram),
+    ("turns_vs_hour_of_day.png", (12, 4), _draw_turns_vs_hour_of_day),
+    ("avg_turns_by_hour.png", (12, 4), _draw_avg_turns_by_hour),
+]
+
+
 def main():
     os.makedirs(OUT_DIR, exist_ok=True)
 
     # --- Step 2: Load & normalize ---
     print("Loading dataset...")
-    df = pd.read_csv(DATA_PATH)
+    df = load_trace()
     print(f"Columns: {list(df.columns)}")
 
     # Normalize timestamps: dataset Timestamp is seconds from 0:00:00 on first day
     df["Timestamp"] = pd.to_numeric(df["Timestamp"], errors="coerce")
     df = df.dropna(subset=["Timestamp"])
     df["Timestamp"] = df["Timestamp"].astype(np.float64)
-    df = df.sort_values("Timestamp").reset_index(drop=True)
+    df = sort_by_timestamp(df)
 
     # Session ID: in-repo CSV does not have "Session ID" (added in v1.2). Infer sessions.
     has_session_col = "Session ID" in df.columns
@@ -50,18 +106,7 @@ def main():
 
     # --- Step 3: Session-level statistics ---
     print("\n--- Session-level stats ---")
-    session_stats = (
-        df.groupby("Session ID", as_index=False)
-        .agg(
-            start_time=("Timestamp", "min"),
-            end_time=("Timestamp", "max"),
-            n_turns=("Timestamp", "count"),
-        )
-        .assign(
-            duration_sec=lambda x: x["end_time"] - x["start_time"],
-        )
-    )
-    session_stats["duration_sec"] = session_stats["duration_sec"].clip(lower=0)
+    session_stats = session_table(df["Session ID"].to_numpy(), df["Timestamp"].to_numpy())
 
     print(f"Mean #turns per session: {session_stats['n_turns'].mean():.2f}")
     print(f"Median #turns: {session_stats['n_turns'].median():.0f}")
@@ -73,99 +118,31 @@ def main():
     # --- Step 4: Temporal analysis ---
     # Hour of day: 0..23 (integer)
     session_stats["hour"] = (session_stats["start_time"] % 86400) / 3600
-    session_stats["hour_int"] = ((session_stats["start_time"] % 86400) // 3600).astype(int)
-    session_stats["day_index"] = (session_stats["start_time"] // 86400).astype(int)
+    # Timestamps are non-negative seconds, so truncating once to int64 equals floor and
+    # the integer bins below avoid float fmod/floor-div; hour/day fit int8/int32 to keep groupby passes narrow
+    st_i = session_stats["start_time"].to_numpy().astype(np.int64)
+    session_stats["hour_int"] = ((st_i % 86400) // 3600).astype(np.int8)
+    session_stats["day_index"] = (st_i // 86400).astype(np.int32)
     # Time window: 1-hour bins over the full trace (bin by start_time)
     bin_sec = 3600
-    session_stats["time_bin"] = (session_stats["start_time"] // bin_sec).astype(int) * bin_sec
-
-    by_hour = (
-        session_stats.groupby("hour_int")
-        .agg(
-            avg_turns=("n_turns", "mean"),
-            p90_turns=("n_turns", lambda x: x.quantile(0.90)),
-            p95_turns=("n_turns", lambda x: x.quantile(0.95)),
-            session_count=("Session ID", "count"),
-        )
-        .reset_index()
-        .rename(columns={"hour_int": "hour"})
-    )
+    session_stats["time_bin"] = (st_i // bin_sec) * bin_sec
 
-    by_bin = (
-        session_stats.groupby("time_bin")
-        .agg(
-            avg_turns=("n_turns", "mean"),
-            p90_turns=("n_turns", lambda x: x.quantile(0.90)),
-            p95_turns=("n_turns", lambda x: x.quantile(0.95)),
-            session_count=("Session ID", "count"),
-        )
-        .reset_index()
-    )
+    by_hour = depth_by(session_stats, "hour_int").rename(columns={"hour_int": "hour"})
+    by_bin = depth_by(session_stats, "time_bin")
 
     # --- Step 5: Visualization ---
     try:
-        import matplotlib
-        matplotlib.use("Agg")
-        import matplotlib.pyplot as plt
+        import matplotlib  # noqa: F401
     except ImportError:
         print("matplotlib not installed; skipping plots.")
-        plt = None
-
-    if plt is not None:
-        # 1) Average #turns vs time (line plot) — use time_bin
-        fig, ax = plt.subplots(figsize=(10, 4))
-        ax.plot(by_bin["time_bin"] / 86400, by_bin["avg_turns"], linewidth=0.8, color="C0")
-        ax.set_xlabel("Time (days from start)")
-        ax.set_ylabel("Avg #turns per session")
-        ax.set_title("Average session depth over time (1-hour bins)")
-        ax.grid(True, alpha=0.3)
-        fig.tight_layout()
-        fig.savefig(OUT_DIR / "avg_turns_vs_time.png", dpi=150)
-        plt.close()
-
-        # 2) Session count vs time
-        fig, ax = plt.subplots(figsize=(10, 4))
-        ax.fill_between(by_bin["time_bin"] / 86400, by_bin["session_count"], alpha=0.6, color="C1")
-        ax.set_xlabel("Time (days from start)")
-        ax.set_ylabel("Session count")
-        ax.set_title("Session count per 1-hour window")
-        ax.grid(True, alpha=0.3)
-        fig.tight_layout()
-        fig.savefig(OUT_DIR / "session_count_vs_time.png", dpi=150)
-        plt.close()
-
-        # 3) Distribution of #turns (histogram)
-        fig, ax = plt.subplots(figsize=(8, 4))
-        max_turns = min(int(session_stats["n_turns"].quantile(0.99)), 50)
-        ax.hist(session_stats["n_turns"].clip(upper=max_turns), bins=range(1, max_turns + 2), align="left", edgecolor="black", alpha=0.7)
-        ax.set_xlabel("#turns per session")
-        ax.set_ylabel("Count")
-        ax.set_title("Distribution of session depth (#turns)")
-        fig.tight_layout()
-        fig.savefig(OUT_DIR / "turns_histogram.png", dpi=150)
-        plt.close()
-
-        # 4) #turns vs hour of day (box plot)
-        fig, ax = plt.subplots(figsize=(12, 4))
-        session_stats.boxplot(column="n_turns", by="hour_int", ax=ax)
-        ax.set_xlabel("Hour of day (from trace start)")
-        ax.set_ylabel("#turns per session")
-        ax.set_title("Session depth by hour of day")
-        plt.suptitle("")
-        fig.tight_layout()
-        fig.savefig(OUT_DIR / "turns_vs_hour_of_day.png", dpi=150)
-        plt.close()
-
-        # 5) Bar: avg turns by hour of day (clearer for report)
-        fig, ax = plt.subplots(figsize=(12, 4))
-        ax.bar(by_hour["hour"], by_hour["avg_turns"], width=0.7, color="steelblue", edgecolor="navy", alpha=0.8)
-        ax.set_xlabel("Hour of day")
-        ax.set_ylabel("Avg #turns per session")
-        ax.set_title("Average session depth by hour of day")
-        fig.tight_layout()
-        fig.savefig(OUT_DIR / "avg_turns_by_hour.png", dpi=150)
-        plt.close()
-
+    else:
+        plot_data = {
+            "session_stats": session_stats,
+            "by_hour": by_hour,
+            "by_bin": by_bin,
+            "days_bin": by_bin["time_bin"].to_numpy() / 86400,
+        }
+        render_plots(PLOTS, plot_data)
         print(f"\nPlots saved to: {OUT_DIR}")
 
     # --- Step 6: Evidence summary (printed) ---
@@ -187,27 +164,47 @@ def main():
     return OUT_DIR, session_stats, by_hour, by_bin
 
 
+def depth_by(session_stats: pd.DataFrame, key: str) -> pd.DataFrame:
+    """Per-group session depth (avg / P90 / P95 #turns) and session count, grouped by key."""
+    gb = session_stats.groupby(key, sort=False)
+    core = gb.agg(
+        avg_turns=("n_turns", "mean"),
+        session_count=("Session ID", "count"),
+    )
+    # One vectorized quantile call instead of a Python lambda per group
+    q = gb["n_turns"].quantile([0.90, 0.95]).unstack().rename(columns={0.90: "p90_turns", 0.95: "p95_turns"})
+    # Groups come out unsorted; order by key once at the end for the CSVs and plots
+    return core.join(q)[["avg_turns", "p90_turns", "p95_turns", "session_count"]].sort_index().reset_index()
+
+
+def box_stats_by(frame: pd.DataFrame, key: str, col: str) -> list:
+    """Box-plot stats (quartiles, 1.5 IQR whiskers, fliers) of col per key group, in the form ax.bxp expects."""
+    values = frame[col]
+    q = values.groupby(frame[key], sort=False).quantile([0.25, 0.50, 0.75]).unstack().sort_index()
+    iqr = q[0.75] - q[0.25]
+    lo = (q[0.25] - 1.5 * iqr).reindex(frame[key]).to_numpy()
+    hi = (q[0.75] + 1.5 * iqr).reindex(frame[key]).to_numpy()
+    inside = (values.to_numpy() >= lo) & (values.to_numpy() <= hi)
+    whis = values[inside].groupby(frame[key][inside], sort=False).agg(["min", "max"])
+    fliers = values[~inside].groupby(frame[key][~inside], sort=False).indices
+    outside = values[~inside].to_numpy()
+    return [
+        dict(label=str(k), q1=q.at[k, 0.25], med=q.at[k, 0.50], q3=q.at[k, 0.75],
+             whislo=whis.at[k, "min"], whishi=whis.at[k, "max"], fliers=outside[fliers.get(k, [])])
+        for k in q.index
+    ]
+
+
 def infer_sessions(df: pd.DataFrame) -> np.ndarray:
     """Infer session IDs when not present: group Conversation log by temporal proximity."""
-    out = np.zeros(len(df), dtype=np.int64)
-    session_id = 0
-    prev_t = -np.inf
+    ts = df["Timestamp"].to_numpy(dtype=np.float64)
     gap_sec = SESSION_GAP_SEC
-    log_type_col = "Log Type" if "Log Type" in df.columns else None
-    for i in range(len(df)):
-        row = df.iloc[i]
-        t = row["Timestamp"]
-        log_type = row[log_type_col] if log_type_col else "Conversation log"
-        if log_type != "Conversation log":
-            session_id += 1
-            out[i] = session_id
-            prev_t = t
-            continue
-        if t - prev_t > gap_sec:
-            session_id += 1
-        out[i] = session_id
-        prev_t = t
-    return out
+    # A new session starts when the gap to the previous request exceeds gap_sec
+    # (the first row always starts one), and every non-conversation row starts its own.
+    breaks = np.diff(ts, prepend=-np.inf) > gap_sec
+    if "Log Type" in df.columns:
+        breaks |= non_conversation_mask(df)
+    return np.cumsum(breaks, dtype=np.int64)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,94 @@
+"""
+Shared helpers for the BurstGPT KV-reuse scripts (kv_reuse_analysis.py, kv_reuse_robustness.py):
+trace loading, session reduction and plot rendering.
+"""
+
+import pandas as pd
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Paths
+REPO_ROOT = Path(__file__).resolve().parent.parent
+DATA_PATH = REPO_ROOT / "data" / "BurstGPT_1.csv"
+TRACE_CACHE_PATH = DATA_PATH.with_suffix(".parquet")
+TRACE_COLUMNS = ["Timestamp", "Log Type", "Session ID"]  # only columns read downstream
+OUT_DIR = REPO_ROOT / "analysis" / "output"
+
+# Fixed margins instead of fig.tight_layout(), which re-measures all text on every save
+PLOT_MARGINS = dict(left=0.08, right=0.98, top=0.9, bottom=0.15)
+PLOT_DPI = 100
+
+
+def load_trace() -> pd.DataFrame:
+    """Load the trace columns used here, caching a Parquet copy next to the CSV on first read."""
+    if TRACE_CACHE_PATH.exists() and TRACE_CACHE_PATH.stat().st_mtime >= DATA_PATH.stat().st_mtime:
+        return pd.read_parquet(TRACE_CACHE_PATH)
+    try:
+        import pyarrow  # noqa: F401  (multi-threaded CSV parser and Parquet writer)
+        has_arrow = True
+    except ImportError:
+        print("pyarrow not installed; parsing CSV with the default engine and not caching as Parquet.")
+        has_arrow = False
+    header = pd.read_csv(DATA_PATH, nrows=0).columns
+    usecols = [c for c in TRACE_COLUMNS if c in header]
+    df = pd.read_csv(
+        DATA_PATH,
+        usecols=usecols,
+        dtype={"Log Type": "category"},
+        engine="pyarrow" if has_arrow else "c",
+    )
+    if has_arrow:
+        df.to_parquet(TRACE_CACHE_PATH, compression="zstd")
+    return df
+
+
+def sort_by_timestamp(df: pd.DataFrame) -> pd.DataFrame:
+    """Order rows by Timestamp, skipping the sort (and its full-frame copy) when the trace is already chronological."""
+    if df["Timestamp"].is_monotonic_increasing:
+        print("Timestamps already sorted; skipping sort.")
+        return df.reset_index(drop=True)
+    print("Timestamps not sorted; sorting.")
+    return df.sort_values("Timestamp", kind="mergesort").reset_index(drop=True)
+
+
+def non_conversation_mask(df: pd.DataFrame) -> np.ndarray:
+    """Boolean mask of rows whose Log Type is not "Conversation log" (compared on category codes, not strings)."""
+    log_type = df["Log Type"].astype("category")
+    codes = log_type.cat.codes.to_numpy()
+    if "Conversation log" not in log_type.cat.categories:
+        return np.ones(len(codes), dtype=bool)
+    return codes != log_type.cat.categories.get_loc("Conversation log")
+
+
+def session_table(sid: np.ndarray, ts: np.ndarray) -> pd.DataFrame:
+    """Per-session start/end time and #turns, reduced over contiguous runs of equal session ID."""
+    if (np.diff(sid) < 0).any():
+        order = np.argsort(sid, kind="stable")
+        sid, ts = sid[order], ts[order]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(sid)) + 1))
+    start_time = np.minimum.reduceat(ts, starts)
+    end_time = np.maximum.reduceat(ts, starts)
+    return pd.DataFrame({
+        "Session ID": sid[starts],
+        "start_time": start_time,
+        "end_time": end_time,
+        "n_turns": np.diff(np.r_[starts, len(sid)]).astype(np.int32),
+        "duration_sec": end_time - start_time,
+    })
+
+
+def render_plots(plots, data, out_dir: Path = OUT_DIR) -> None:
+    """Draw each plot on its own Figure and save it; PNG encoding of independent figures runs in parallel threads."""
+    # Figure objects (not pyplot) hold no global state, so threads never share a figure
+    from matplotlib.figure import Figure
+
+    def render(plot):
+        fname, figsize, draw = plot
+        fig = Figure(figsize=figsize)
+        draw(fig.subplots(), data)
+        fig.subplots_adjust(**PLOT_MARGINS)
+        fig.savefig(out_dir / fname, dpi=PLOT_DPI)
+
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        list(ex.map(render, plots))
@@ -7,221 +7,286 @@ BurstGPT KV-reuse analysis: robustness extensions.
 All outputs use new filenames; does not overwrite baseline results.
 """
 
+import argparse
 import os
 import pandas as pd
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-REPO_ROOT = Path(__file__).resolve().parent.parent
-DATA_PATH = REPO_ROOT / "data" / "BurstGPT_1.csv"
-OUT_DIR = REPO_ROOT / "analysis" / "output"
+from kv_reuse_common import (
+    DATA_PATH, OUT_DIR, load_trace, non_conversation_mask, render_plots, session_table, sort_by_timestamp,
+)
+
+CACHE_DIR = OUT_DIR / "cache"
+CACHED_FRAMES = ("session_stats", "by_hour", "by_bin")
 MIN_SESSION_COUNT = 100  # for sparse-bin filtering
 
 
+def infer_sessions_by_gap(df: pd.DataFrame, gap_secs) -> dict:
+    """Infer session IDs for several gap values from one pass over the timestamps. Returns {gap_sec: session IDs}."""
+    ts = df["Timestamp"].to_numpy(dtype=np.float64)
+    # A new session starts when the gap to the previous request exceeds gap_sec
+    # (the first row always starts one), and every non-conversation row starts its own.
+    dt = np.diff(ts, prepend=-np.inf)
+    non_conv = non_conversation_mask(df) if "Log Type" in df.columns else None
+    out = {}
+    for gap_sec in gap_secs:
+        breaks = dt > gap_sec
+        if non_conv is not None:
+            breaks |= non_conv
+        out[gap_sec] = np.cumsum(breaks, dtype=np.int64)
+    return out
+
+
 def infer_sessions(df: pd.DataFrame, gap_sec: int) -> np.ndarray:
     """Infer session IDs: group Conversation log by temporal proximity (gap_sec)."""
-    out = np.zeros(len(df), dtype=np.int64)
-    session_id = 0
-    prev_t = -np.inf
-    log_type_col = "Log Type" if "Log Type" in df.columns else None
-    for i in range(len(df)):
-        row = df.iloc[i]
-        t = row["Timestamp"]
-        log_type = row[log_type_col] if log_type_col else "Conversation log"
-        if log_type != "Conversation log":
-            session_id += 1
-            out[i] = session_id
-            prev_t = t
-            continue
-        if t - prev_t > gap_sec:
-            session_id += 1
-        out[i] = session_id
-        prev_t = t
-    return out
+    return infer_sessions_by_gap(df, [gap_sec])[gap_sec]
 
 
-def run_gap(df: pd.DataFrame, gap_sec: int, label: str) -> tuple:
-    """Compute session stats, by_hour, by_bin for a given session gap. Returns (session_stats, by_hour, by_bin)."""
-    df = df.copy()
-    df["Session ID"] = infer_sessions(df, gap_sec)
-    session_stats = (
-        df.groupby("Session ID", as_index=False)
-        .agg(
-            start_time=("Timestamp", "min"),
-            end_time=("Timestamp", "max"),
-            n_turns=("Timestamp", "count"),
-        )
-        .assign(duration_sec=lambda x: (x["end_time"] - x["start_time"]).clip(lower=0))
-    )
-    session_stats["hour_int"] = ((session_stats["start_time"] % 86400) // 3600).astype(int)
-    session_stats["time_bin"] = (session_stats["start_time"] // 3600).astype(int) * 3600
-    session_stats["ge2"] = (session_stats["n_turns"] >= 2).astype(int)
-    session_stats["ge3"] = (session_stats["n_turns"] >= 3).astype(int)
-
-    by_hour = (
-        session_stats.groupby("hour_int")
-        .agg(
-            avg_turns=("n_turns", "mean"),
-            session_count=("Session ID", "count"),
-            frac_ge2=("ge2", "mean"),
-            frac_ge3=("ge3", "mean"),
-        )
-        .reset_index()
-        .rename(columns={"hour_int": "hour"})
-    )
-    by_bin = (
-        session_stats.groupby("time_bin")
-        .agg(
-            avg_turns=("n_turns", "mean"),
-            session_count=("Session ID", "count"),
-            frac_ge2=("ge2", "mean"),
-            frac_ge3=("ge3", "mean"),
-        )
-        .reset_index()
-    )
+def depth_fractions(keys: np.ndarray, n_turns: np.ndarray, key_name: str) -> pd.DataFrame:
+    """Per-key avg #turns, session count and fraction of sessions with >=2 / >=3 turns, reduced over sorted key runs."""
+    # time_bin is already non-decreasing (sessions are in start order); hour_int needs one stable sort
+    if (np.diff(keys) < 0).any():
+        order = np.argsort(keys, kind="stable")
+        keys, n_turns = keys[order], n_turns[order]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+    count = np.diff(np.r_[starts, len(keys)])
+    return pd.DataFrame({
+        key_name: keys[starts],
+        "avg_turns": np.add.reduceat(n_turns, starts, dtype=np.int64) / count,
+        "session_count": count,
+        # Boolean masks are summed per run directly; no ge2/ge3 columns are stored
+        "frac_ge2": np.add.reduceat(n_turns >= 2, starts, dtype=np.int64) / count,
+        "frac_ge3": np.add.reduceat(n_turns >= 3, starts, dtype=np.int64) / count,
+    })
+
+
+def run_gap(df: pd.DataFrame, sid: np.ndarray) -> tuple:
+    """Compute session stats, by_hour, by_bin for one session gap's inferred IDs. Returns (session_stats, by_hour, by_bin)."""
+    # df is shared across gaps: session IDs stay a separate array instead of a column on a copy
+    session_stats = session_table(sid, df["Timestamp"].to_numpy())
+    # Timestamps are non-negative seconds: truncating once to int64 equals floor, then bin in integers.
+    # Narrow dtypes (int32 n_turns, int8 hour) cut the bytes each aggregation pass moves.
+    st_i = session_stats["start_time"].to_numpy().astype(np.int64)
+    session_stats["hour_int"] = ((st_i % 86400) // 3600).astype(np.int8)
+    session_stats["time_bin"] = (st_i // 3600) * 3600
+
+    n_turns = session_stats["n_turns"].to_numpy()
+    by_hour = depth_fractions(session_stats["hour_int"].to_numpy(), n_turns, "hour")
+    by_bin = depth_fractions(session_stats["time_bin"].to_numpy(), n_turns, "time_bin")
     return session_stats, by_hour, by_bin
 
 
-def main():
-    os.makedirs(OUT_DIR, exist_ok=True)
-    print("Loading dataset...")
-    df = pd.read_csv(DATA_PATH)
-    df["Timestamp"] = pd.to_numeric(df["Timestamp"], errors="coerce")
-    df = df.dropna(subset=["Timestamp"]).sort_values("Timestamp").reset_index(drop=True)
+def _cache_path(name: str, label: str) -> Path:
+    # Keyed on the trace mtime so a changed CSV never serves stale results
+    return CACHE_DIR / f"{name}_{label}_{int(os.path.getmtime(DATA_PATH))}.parquet"
 
-    gaps = [
-        (900, "15m"),
-        (1800, "30m"),
-        (3600, "60m"),
-    ]
-    results = {}
-    for gap_sec, label in gaps:
-        print(f"Computing gap = {label}...")
-        session_stats, by_hour, by_bin = run_gap(df, gap_sec, label)
-        results[label] = {
-            "session_stats": session_stats,
-            "by_hour": by_hour,
-            "by_bin": by_bin,
-        }
-        by_hour.to_csv(OUT_DIR / f"by_hour_{label}.csv", index=False)
-        by_bin.to_csv(OUT_DIR / f"by_bin_{label}.csv", index=False)
-        n_sessions = len(session_stats)
-        frac_ge2 = (session_stats["n_turns"] >= 2).mean()
-        frac_ge3 = (session_stats["n_turns"] >= 3).mean()
-        print(f"  sessions={n_sessions}, frac≥2={frac_ge2:.4f}, frac≥3={frac_ge3:.4f}, avg_turns={session_stats['n_turns'].mean():.3f}")
 
-    # Sensitivity summary table
-    sensitivity_rows = []
-    for label in ["15m", "30m", "60m"]:
-        ss = results[label]["session_stats"]
-        by_h = results[label]["by_hour"]
-        sensitivity_rows.append({
-            "gap": label,
-            "n_sessions": len(ss),
-            "frac_ge2_turns": (ss["n_turns"] >= 2).mean(),
-            "frac_ge3_turns": (ss["n_turns"] >= 3).mean(),
-            "avg_turns": ss["n_turns"].mean(),
-            "avg_turns_std_over_hours": by_h["avg_turns"].std(),
-        })
-    sensitivity_df = pd.DataFrame(sensitivity_rows)
-    sensitivity_df.to_csv(OUT_DIR / "sensitivity_session_gap.csv", index=False)
-    print("\nSensitivity summary (sensitivity_session_gap.csv):")
-    print(sensitivity_df.to_string(index=False))
+def load_cached_gap(label: str):
+    """Return the cached {session_stats, by_hour, by_bin} frames for a gap label, or None if any is missing."""
+    paths = {name: _cache_path(name, label) for name in CACHED_FRAMES}
+    if not all(path.exists() for path in paths.values()):
+        return None
+    return {name: pd.read_parquet(path) for name, path in paths.items()}
+
 
+def save_cached_gap(label: str, frames: dict) -> None:
+    """Persist a gap's result frames as Parquet so reruns (e.g. plot tweaks) skip the pipeline."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
     try:
-        import matplotlib
-        matplotlib.use("Agg")
-        import matplotlib.pyplot as plt
+        for name in CACHED_FRAMES:
+            path = _cache_path(name, label)
+            frames[name].to_parquet(path)
+            # Entries keyed on an older trace mtime can never be served again
+            for stale in CACHE_DIR.glob(f"{name}_{label}_*.parquet"):
+                if stale != path:
+                    stale.unlink()
     except ImportError:
-        print("matplotlib not available; skipping plots.")
-        return
+        print("pyarrow not installed; not caching per-gap results.")
 
+
+def _draw_sensitivity_avg_turns_by_hour(ax, d):
     # --- Plot 1: Sensitivity — avg_turns by hour for 15m, 30m, 60m ---
-    fig, ax = plt.subplots(figsize=(10, 4))
     for label, color in [("15m", "C0"), ("30m", "C1"), ("60m", "C2")]:
-        by_h = results[label]["by_hour"]
+        by_h = d["results"][label]["by_hour"]
         ax.plot(by_h["hour"], by_h["avg_turns"], label=f"gap={label}", color=color, linewidth=1.2)
     ax.set_xlabel("Hour of day")
     ax.set_ylabel("Avg #turns per session")
     ax.set_title("Sensitivity: average session depth by hour (session-gap heuristic)")
     ax.legend()
     ax.grid(True, alpha=0.3)
-    fig.tight_layout()
-    fig.savefig(OUT_DIR / "sensitivity_avg_turns_by_hour.png", dpi=150)
-    plt.close()
 
+
+def _draw_fraction_ge2_by_hour(ax, d):
     # --- Plot 2: Fraction ≥2 turns by hour (30m baseline) ---
-    by_h = results["30m"]["by_hour"]
-    fig, ax = plt.subplots(figsize=(10, 4))
+    by_h = d["by_h"]
     ax.bar(by_h["hour"], by_h["frac_ge2"] * 100, width=0.7, color="steelblue", edgecolor="navy", alpha=0.8)
     ax.set_xlabel("Hour of day")
     ax.set_ylabel("Fraction of sessions with ≥2 turns (%)")
     ax.set_title("Fraction of multi-turn sessions by hour of day (30m gap)")
-    fig.tight_layout()
-    fig.savefig(OUT_DIR / "fraction_ge2_by_hour.png", dpi=150)
-    plt.close()
 
+
+def _draw_fraction_ge2_vs_time(ax, d):
     # --- Plot 3: Fraction ≥2 turns vs time (30m, 1-hour bins) ---
-    by_bin = results["30m"]["by_bin"]
-    fig, ax = plt.subplots(figsize=(10, 4))
-    ax.plot(by_bin["time_bin"] / 86400, by_bin["frac_ge2"] * 100, linewidth=0.8, color="C0")
+    ax.plot(d["days_bin"], d["by_bin"]["frac_ge2"] * 100, linewidth=0.8, color="C0")
     ax.set_xlabel("Time (days from start)")
     ax.set_ylabel("Fraction of sessions with ≥2 turns (%)")
     ax.set_title("Fraction of multi-turn sessions over time (1-hour bins, 30m gap)")
     ax.grid(True, alpha=0.3)
-    fig.tight_layout()
-    fig.savefig(OUT_DIR / "fraction_ge2_vs_time.png", dpi=150)
-    plt.close()
 
+
+def _draw_fraction_ge3_by_hour(ax, d):
     # --- Plot 4: Fraction ≥3 turns by hour ---
-    fig, ax = plt.subplots(figsize=(10, 4))
+    by_h = d["by_h"]
     ax.bar(by_h["hour"], by_h["frac_ge3"] * 100, width=0.7, color="darkorange", edgecolor="brown", alpha=0.8)
     ax.set_xlabel("Hour of day")
     ax.set_ylabel("Fraction of sessions with ≥3 turns (%)")
     ax.set_title("Fraction of deep sessions (≥3 turns) by hour of day (30m gap)")
-    fig.tight_layout()
-    fig.savefig(OUT_DIR / "fraction_ge3_by_hour.png", dpi=150)
-    plt.close()
 
+
+def _draw_fraction_ge3_vs_time(ax, d):
     # --- Plot 5: Fraction ≥3 turns vs time ---
-    fig, ax = plt.subplots(figsize=(10, 4))
-    ax.plot(by_bin["time_bin"] / 86400, by_bin["frac_ge3"] * 100, linewidth=0.8, color="C1")
+    ax.plot(d["days_bin"], d["by_bin"]["frac_ge3"] * 100, linewidth=0.8, color="C1")
     ax.set_xlabel("Time (days from start)")
     ax.set_ylabel("Fraction of sessions with ≥3 turns (%)")
     ax.set_title("Fraction of deep sessions over time (1-hour bins, 30m gap)")
     ax.grid(True, alpha=0.3)
-    fig.tight_layout()
-    fig.savefig(OUT_DIR / "fraction_ge3_vs_time.png", dpi=150)
-    plt.close()
 
-    # --- Sparse-bin filtering: keep bins with session_count >= MIN_SESSION_COUNT ---
-    by_bin_f = by_bin[by_bin["session_count"] >= MIN_SESSION_COUNT].copy()
-    print(f"\nSparse-bin filter: {len(by_bin)} → {len(by_bin_f)} bins (min {MIN_SESSION_COUNT} sessions)")
 
+def _draw_avg_turns_vs_time_min100(ax, d):
     # --- Plot 6: Avg turns vs time (filtered) ---
-    fig, ax = plt.subplots(figsize=(10, 4))
-    ax.plot(by_bin_f["time_bin"] / 86400, by_bin_f["avg_turns"], linewidth=0.8, color="C0")
+    ax.plot(d["days_bin_f"], d["by_bin_f"]["avg_turns"], linewidth=0.8, color="C0")
     ax.set_xlabel("Time (days from start)")
     ax.set_ylabel("Avg #turns per session")
     ax.set_title(f"Average session depth over time (1-hour bins, ≥{MIN_SESSION_COUNT} sessions per bin)")
     ax.grid(True, alpha=0.3)
-    fig.tight_layout()
-    fig.savefig(OUT_DIR / "avg_turns_vs_time_min100.png", dpi=150)
-    plt.close()
 
+
+def _draw_fraction_ge2_vs_time_min100(ax, d):
     # --- Plot 7: Fraction ≥2 vs time (filtered) ---
-    fig, ax = plt.subplots(figsize=(10, 4))
-    ax.plot(by_bin_f["time_bin"] / 86400, by_bin_f["frac_ge2"] * 100, linewidth=0.8, color="C0")
+    ax.plot(d["days_bin_f"], d["by_bin_f"]["frac_ge2"] * 100, linewidth=0.8, color="C0")
     ax.set_xlabel("Time (days from start)")
     ax.set_ylabel("Fraction of sessions with ≥2 turns (%)")
     ax.set_title(f"Fraction of multi-turn sessions over time (≥{MIN_SESSION_COUNT} sessions per bin)")
     ax.grid(True, alpha=0.3)
-    fig.tight_layout()
-    fig.savefig(OUT_DIR / "fraction_ge2_vs_time_min100.png", dpi=150)
-    plt.close()
 
+
+# (output filename, figsize, draw function)
+PLOTS = [
+    ("sensitivity_avg_turns_by_hour.png", (10, 4), _draw_sensitivity_avg_turns_by_hour),
+    ("fraction_ge2_by_hour.png", (10, 4), _draw_fraction_ge2_by_hour),
+    ("fraction_ge2_vs_time.png", (10, 4), _draw_fraction_ge2_vs_time),
+    ("fraction_ge3_by_hour.png", (10, 4), _draw_fraction_ge3_by_hour),
+    ("fraction_ge3_vs_time.png", (10, 4), _draw_fraction_ge3_vs_time),
+    ("avg_turns_vs_time_min100.png", (10, 4), _draw_avg_turns_vs_time_min100),
+    ("fraction_ge2_vs_time_min100.png", (10, 4), _draw_fraction_ge2_vs_time_min100),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--per-gap-csv",
+        action="store_true",
+        help="also write by_hour_<gap>.csv / by_bin_<gap>.csv for each gap (besides the combined all-gaps files)",
+    )
+    args = parser.parse_args()
+
+    os.makedirs(OUT_DIR, exist_ok=True)
+    gaps = [
+        (900, "15m"),
+        (1800, "30m"),
+        (3600, "60m"),
+    ]
+    results = {}
+    for gap_sec, label in gaps:
+        cached = load_cached_gap(label)
+        if cached is not None:
+            print(f"Using cached results for gap = {label} ({CACHE_DIR})")
+            results[label] = cached
+    missing = [(gap_sec, label) for gap_sec, label in gaps if label not in results]
+    if missing:
+        print("Loading dataset...")
+        df = load_trace()
+        df["Timestamp"] = pd.to_numeric(df["Timestamp"], errors="coerce")
+        df = sort_by_timestamp(df.dropna(subset=["Timestamp"]))
+
+        sids = infer_sessions_by_gap(df, [gap_sec for gap_sec, _ in missing])
+        # Gaps are independent; threads share df and the ID arrays (no pickling), and NumPy/pandas release the GIL
+        print(f"Computing gaps = {', '.join(label for _, label in missing)}...")
+        with ThreadPoolExecutor(max_workers=len(missing)) as ex:
+            futures = {label: ex.submit(run_gap, df, sids[gap_sec]) for gap_sec, label in missing}
+        for gap_sec, label in missing:
+            session_stats, by_hour, by_bin = futures[label].result()
+            results[label] = {
+                "session_stats": session_stats,
+                "by_hour": by_hour,
+                "by_bin": by_bin,
+            }
+            save_cached_gap(label, results[label])
+
+    for gap_sec, label in gaps:
+        print(f"Gap = {label}:")
+        session_stats = results[label]["session_stats"]
+        by_hour = results[label]["by_hour"]
+        by_bin = results[label]["by_bin"]
+        if args.per_gap_csv:
+            by_hour.to_csv(OUT_DIR / f"by_hour_{label}.csv", index=False)
+            by_bin.to_csv(OUT_DIR / f"by_bin_{label}.csv", index=False)
+        n_sessions = len(session_stats)
+        frac_ge2 = (session_stats["n_turns"] >= 2).mean()
+        frac_ge3 = (session_stats["n_turns"] >= 3).mean()
+        print(f"  sessions={n_sessions}, frac≥2={frac_ge2:.4f}, frac≥3={frac_ge3:.4f}, avg_turns={session_stats['n_turns'].mean():.3f}")
+
+    # All gaps in one long table per kind (gap column), written once
+    for kind in ("by_hour", "by_bin"):
+        combined = pd.concat([results[label][kind].assign(gap=label) for _, label in gaps], ignore_index=True)
+        try:
+            combined.to_parquet(OUT_DIR / f"{kind}_all_gaps.parquet", index=False)
+        except ImportError:
+            combined.to_csv(OUT_DIR / f"{kind}_all_gaps.csv", index=False)
+
+    # Sensitivity summary table
+    sensitivity_rows = []
+    for label in ["15m", "30m", "60m"]:
+        ss = results[label]["session_stats"]
+        by_h = results[label]["by_hour"]
+        sensitivity_rows.append({
+            "gap": label,
+            "n_sessions": len(ss),
+            "frac_ge2_turns": (ss["n_turns"] >= 2).mean(),
+            "frac_ge3_turns": (ss["n_turns"] >= 3).mean(),
+            "avg_turns": ss["n_turns"].mean(),
+            "avg_turns_std_over_hours": by_h["avg_turns"].std(),
+        })
+    sensitivity_df = pd.DataFrame(sensitivity_rows)
+    sensitivity_df.to_csv(OUT_DIR / "sensitivity_session_gap.csv", index=False)
+    print("\nSensitivity summary (sensitivity_session_gap.csv):")
+    print(sensitivity_df.to_string(index=False))
+
+    # --- Sparse-bin filtering: keep bins with session_count >= MIN_SESSION_COUNT ---
+    by_bin = results["30m"]["by_bin"]
+    by_bin_f = by_bin[by_bin["session_count"] >= MIN_SESSION_COUNT].copy()
+    print(f"\nSparse-bin filter: {len(by_bin)} → {len(by_bin_f)} bins (min {MIN_SESSION_COUNT} sessions)")
     # Persist filtered by_bin for report
     by_bin_f.to_csv(OUT_DIR / "by_bin_30m_min100.csv", index=False)
+
+    try:
+        import matplotlib  # noqa: F401
+    except ImportError:
+        print("matplotlib not available; skipping plots.")
+        return
+
+    plot_data = {
+        "results": results,
+        "by_h": results["30m"]["by_hour"],
+        "by_bin": by_bin,
+        "by_bin_f": by_bin_f,
+        "days_bin": by_bin["time_bin"].to_numpy() / 86400,
+        "days_bin_f": by_bin_f["time_bin"].to_numpy() / 86400,
+    }
+    render_plots(PLOTS, plot_data)
     print(f"Plots and CSVs saved to {OUT_DIR}")
 
 
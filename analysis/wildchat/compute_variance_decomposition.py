@@ -13,38 +13,38 @@ OUT_DIR = BASE / "output"
 csv_path = OUT_DIR / "wildchat_hourly_windows.csv"
 out_path = OUT_DIR / "wildchat_windowed_variance_stats.json"
 
+def cv_by(df, key):
+    """Mean, std and size of avg_turn / avg_context_length per key group, in one groupby pass."""
+    # Only means of the per-group CVs are used, so group order does not matter
+    return df.groupby(key, sort=False).agg(
+        m_t=("avg_turn", "mean"),
+        s_t=("avg_turn", "std"),
+        m_c=("avg_context_length", "mean"),
+        s_c=("avg_context_length", "std"),
+        n=("avg_turn", "size"),
+    )
+
+
 def main():
     df = pd.read_csv(csv_path)
     df["hour_bin_dt"] = pd.to_datetime(df["hour_bin_dt"], utc=True)
     df["date"] = df["hour_bin_dt"].dt.date
 
     # Intra-day: for each day, CV of avg_turn and avg_context across its 24 hourly bins
-    daily_cv_turn = []
-    daily_cv_context = []
-    for date, grp in df.groupby("date"):
-        at = grp["avg_turn"]
-        ac = grp["avg_context_length"]
-        if at.mean() > 0 and len(at) >= 6:
-            daily_cv_turn.append(at.std() / at.mean())
-        if ac.mean() > 0 and len(ac) >= 6:
-            daily_cv_context.append(ac.std() / ac.mean())
-    mean_intraday_cv_turn = float(pd.Series(daily_cv_turn).mean())
-    std_intraday_cv_turn = float(pd.Series(daily_cv_turn).std())
-    mean_intraday_cv_context = float(pd.Series(daily_cv_context).mean())
-    std_intraday_cv_context = float(pd.Series(daily_cv_context).std())
+    g = cv_by(df, "date")
+    daily_cv_turn = (g["s_t"] / g["m_t"])[(g["m_t"] > 0) & (g["n"] >= 6)]
+    daily_cv_context = (g["s_c"] / g["m_c"])[(g["m_c"] > 0) & (g["n"] >= 6)]
+    mean_intraday_cv_turn = float(daily_cv_turn.mean())
+    std_intraday_cv_turn = float(daily_cv_turn.std())
+    mean_intraday_cv_context = float(daily_cv_context.mean())
+    std_intraday_cv_context = float(daily_cv_context.std())
 
     # Inter-day: for each hour_of_day, CV of avg_turn and avg_context across days
-    interday_cv_turn = []
-    interday_cv_context = []
-    for hod, grp in df.groupby("hour_of_day"):
-        at = grp["avg_turn"]
-        ac = grp["avg_context_length"]
-        if at.mean() > 0:
-            interday_cv_turn.append(at.std() / at.mean())
-        if ac.mean() > 0:
-            interday_cv_context.append(ac.std() / ac.mean())
-    mean_interday_cv_turn = float(pd.Series(interday_cv_turn).mean())
-    mean_interday_cv_context = float(pd.Series(interday_cv_context).mean())
+    g = cv_by(df, "hour_of_day")
+    interday_cv_turn = (g["s_t"] / g["m_t"])[g["m_t"] > 0]
+    interday_cv_context = (g["s_c"] / g["m_c"])[g["m_c"] > 0]
+    mean_interday_cv_turn = float(interday_cv_turn.mean())
+    mean_interday_cv_context = float(interday_cv_context.mean())
 
     # Global CV (from same CSV: std/mean across all hourly windows)
     global_cv_turn = float(df["avg_turn"].std() / df["avg_turn"].mean())
@@ -5,6 +5,7 @@ Produces distributions, timestamp validation, arrival process, model-based concu
 All values computed from the dataset; no fabrication.
 """
 
+import argparse
 import os
 import json
 import numpy as np
@@ -12,6 +13,8 @@ import pandas as pd
 from pathlib import Path
 from datetime import datetime, timezone
 
+from wildchat_common import conversation_words, load_cached_frame, save_cached_frame, timestamp_seconds
+
 # Use project-local cache for HuggingFace (avoids ~/.cache permission issues)
 BASE = Path(__file__).resolve().parent
 _hf_cache = str(BASE / "hf_cache")
@@ -21,78 +24,177 @@ os.environ["HF_HOME"] = _hf_cache
 OUT_DIR = BASE / "output"
 os.makedirs(OUT_DIR, exist_ok=True)
 
+# Rows per Arrow batch during extraction (bounds flattened-content memory)
+EXTRACT_BATCH_ROWS = 50_000
+
+# Local copy of the train split; loading it needs no Hub revision checks
+LOCAL_DATASET_DIR = BASE / "wildchat_local"
+
+# Extracted per-conversation arrays, reused across runs while the dataset files are unchanged
+CACHE_DIR = BASE / "cache"
+EXTRACTED_CACHE = CACHE_DIR / "wildchat_extracted.parquet"
+EXTRACTED_META = EXTRACTED_CACHE.with_suffix(".json")
+
 # Will be populated after load
 stats = {}
 
 
+def extract_batch(tbl):
+    """Per-conversation arrays from one Arrow batch; conversation text never leaves Arrow."""
+    conv_len, words_sum = conversation_words(tbl.column("conversation"))
+    return {
+        "conversation_id": tbl.column("conversation_id").to_numpy(zero_copy_only=False),
+        "turn": tbl.column("turn").to_numpy(zero_copy_only=False),
+        "timestamp_unix": timestamp_seconds(tbl.column("timestamp")),
+        "model": tbl.column("model").to_numpy(zero_copy_only=False),
+        "conv_len": conv_len,
+        "words_sum": words_sum,
+    }
+
+
+def extract_columns(ds, batch_rows=EXTRACT_BATCH_ROWS):
+    """Extract per-conversation arrays in fixed-size batches to bound peak memory."""
+    arrow_ds = ds.with_format("arrow")
+    parts = [extract_batch(tbl) for tbl in arrow_ds.iter(batch_size=batch_rows)]
+    if not parts:
+        # Zero-row dataset yields no batches; extract the empty table so every array keeps its dtype
+        parts = [extract_batch(arrow_ds[:0])]
+    return {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+
+
+def _import_plt():
+    """pyplot on the Agg backend, or None if matplotlib is not installed."""
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        return None
+    return plt
+
+
+def sorted_quantile(a_sorted, q):
+    """Linearly interpolated quantile of an already-sorted array (same as Series.quantile)."""
+    pos = q * (len(a_sorted) - 1)
+    lo = int(pos)
+    hi = min(lo + 1, len(a_sorted) - 1)
+    return float(a_sorted[lo] + (a_sorted[hi] - a_sorted[lo]) * (pos - lo))
+
+
+def load_wildchat():
+    """Load the WildChat train split from the local copy, saving one on first download."""
+    from datasets import load_dataset, load_from_disk
+    try:
+        return load_from_disk(str(LOCAL_DATASET_DIR))
+    except FileNotFoundError:
+        ds = load_dataset("allenai/WildChat", split="train")
+        ds.save_to_disk(str(LOCAL_DATASET_DIR))
+        return ds
+
+
+def _serialize_np_scalar(v):
+    return float(v) if not np.isnan(v) else None
+
+
+def _serialize_fallback(v):
+    # Subclasses (bool, other NumPy widths) and anything unknown
+    if isinstance(v, (int, float, str, type(None))):
+        return v
+    if isinstance(v, (np.integer, np.floating)):
+        return _serialize_np_scalar(v)
+    if isinstance(v, (list, tuple)):
+        return [_serialize(x) for x in v]
+    if isinstance(v, dict):
+        return {str(k): _serialize(x) for k, x in v.items()}
+    return str(v)
+
+
+def _pass(v):
+    return v
+
+
+_SERIALIZE_DISPATCH = {
+    int: _pass,
+    float: _pass,
+    str: _pass,
+    type(None): _pass,
+    np.int64: _serialize_np_scalar,
+    np.float64: _serialize_np_scalar,
+    list: lambda v: [_serialize(x) for x in v],
+    tuple: lambda v: [_serialize(x) for x in v],
+    dict: lambda v: {str(k): _serialize(x) for k, x in v.items()},
+}
+
+
+def _serialize(v):
+    """JSON-safe copy of a stats value: one dict lookup on the exact type, isinstance chain otherwise."""
+    return _SERIALIZE_DISPATCH.get(type(v), _serialize_fallback)(v)
+
+
 def main():
     global stats
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--plots",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="render the PNG figures (--no-plots writes only the stats JSON, CSV and report)",
+    )
+    args = parser.parse_args()
+
     print("Step 1 — Load Dataset")
-    from datasets import load_dataset
-    ds = load_dataset("allenai/WildChat", split="train")
+    ds = load_wildchat()
     n_rows = len(ds)
     print(f"  Dataset size: {n_rows}")
     print(f"  Column names: {ds.column_names}")
 
     # Inspect types and first row
-    first = ds[0]
-    print("  First row keys:", list(first.keys()))
-    for k in ["conversation_id", "conversation", "turn", "timestamp", "model"]:
-        v = first.get(k)
-        print(f"    {k}: type={type(v).__name__}, sample={repr(v)[:80] if v is not None else 'None'}...")
-
-    # Build DataFrame: extract needed columns without holding full conversation text
-    ts_list = []
-    turn_list = []
-    conv_id_list = []
-    model_list = []
-    turn_from_conv_list = []
-    words_per_turn_list = []  # list of lists, one per conversation
-    model_per_conv = []
-
-    for i in range(n_rows):
-        row = ds[i]
-        conv_id_list.append(row["conversation_id"])
-        turn_list.append(row["turn"])
-        model_list.append(row["model"])
-        ts = row["timestamp"]
-        if hasattr(ts, "timestamp"):
-            ts_list.append(ts.timestamp())
-        elif isinstance(ts, (int, float)):
-            ts_list.append(float(ts))
-        else:
-            try:
-                dt = pd.Timestamp(ts)
-                ts_list.append(dt.timestamp())
-            except Exception:
-                ts_list.append(np.nan)
-        conv = row.get("conversation") or []
-        turn_from_conv_list.append(len(conv) // 2 if conv else 0)  # user-assistant pairs
-        words = []
-        for ut in conv:
-            c = ut.get("content") or ""
-            words.append(len(c.split()))
-        words_per_turn_list.append(words)
+    if n_rows:
+        first = ds[0]
+        print("  First row keys:", list(first.keys()))
+        for k in ["conversation_id", "conversation", "turn", "timestamp", "model"]:
+            v = first.get(k)
+            print(f"    {k}: type={type(v).__name__}, sample={repr(v)[:80] if v is not None else 'None'}...")
+
+    # Build DataFrame: extract needed columns batch by batch from the Arrow table (no per-row Python dicts)
+    cached = load_cached_frame(ds, EXTRACTED_CACHE, EXTRACTED_META)
+    if cached is None:
+        cols = extract_columns(ds)
+        save_cached_frame(ds, pd.DataFrame(cols), EXTRACTED_CACHE, EXTRACTED_META)
+    else:
+        print(f"  Using cached extraction: {EXTRACTED_CACHE}")
+        cols = {k: cached[k].to_numpy() for k in cached.columns}
+    conv_len = cols["conv_len"]
+    words_sum = cols["words_sum"]
+
+    # Words per turn: per-conversation average
+    avg_words = np.zeros(n_rows)
+    nz = conv_len > 0
+    avg_words[nz] = words_sum[nz] / conv_len[nz]
 
     df = pd.DataFrame({
-        "conversation_id": conv_id_list,
-        "turn": turn_list,
-        "timestamp_unix": ts_list,
-        "model": model_list,
-        "turn_from_conv": turn_from_conv_list,
+        "conversation_id": cols["conversation_id"],
+        "turn": cols["turn"].astype(np.int16),
+        "timestamp_unix": cols["timestamp_unix"],
+        "model": pd.Categorical(cols["model"]),  # a few dozen labels; groupbys work on int codes
+        "turn_from_conv": (conv_len // 2).astype(np.int16),  # user-assistant pairs
+        "avg_words_per_turn": avg_words,
     })
-    df["timestamp_dt"] = pd.to_datetime(df["timestamp_unix"], unit="s", utc=True)
     df = df.dropna(subset=["timestamp_unix"]).sort_values("timestamp_unix").reset_index(drop=True)
+    # Whole and fractional seconds scaled separately, as to_datetime(unit="s") does, so the ns values match it
+    ts = df["timestamp_unix"].to_numpy()
+    whole = np.trunc(ts)
+    ts_ns = whole.astype(np.int64) * 1_000_000_000 + (np.round(ts - whole, 9) * 1e9).astype(np.int64)
+    df["timestamp_dt"] = pd.DatetimeIndex(ts_ns, tz="UTC")
     n_valid = len(df)
     stats["n_rows"] = n_rows
     stats["n_valid_ts"] = n_valid
     stats["columns"] = ds.column_names
 
-    # Words per turn: per-conversation average
-    avg_words = [np.mean(w) if w else 0 for w in words_per_turn_list]
-    df["avg_words_per_turn"] = [avg_words[i] for i in range(n_valid)]
-
     print(f"  Valid rows (non-null timestamp): {n_valid}")
+    if n_valid == 0:
+        print("  No rows with a timestamp; nothing to analyze.")
+        return stats, OUT_DIR
     print("  Sample timestamp_dt:", df["timestamp_dt"].iloc[0])
     print("  Sample timestamp_unix:", df["timestamp_unix"].iloc[0])
 
@@ -110,21 +212,17 @@ def main():
     print(f"  max timestamp: {t_max} ({stats['ts_max_dt']})")
     print(f"  span: {span_days:.1f} days")
 
-    df["hour"] = df["timestamp_dt"].dt.hour
-    df["dayofweek"] = df["timestamp_dt"].dt.dayofweek
-    df["date"] = df["timestamp_dt"].dt.date
+    # Calendar fields straight from epoch seconds (UTC); 1970-01-01 was a Thursday (dayofweek 3)
+    ts_sec = ts_ns // 1_000_000_000
+    df["hour"] = ((ts_sec // 3600) % 24).astype(np.int8)
+    df["dayofweek"] = ((ts_sec // 86400 + 3) % 7).astype(np.int8)
     dup = df["timestamp_unix"].duplicated(keep=False)
     stats["n_duplicate_ts"] = dup.sum()
     stats["strictly_increasing"] = (df["timestamp_unix"].diff().dropna() >= 0).all()
     print(f"  Duplicate timestamps: {dup.sum()}")
     print(f"  Strictly increasing (sorted): {stats['strictly_increasing']}")
 
-    try:
-        import matplotlib
-        matplotlib.use("Agg")
-        import matplotlib.pyplot as plt
-    except ImportError:
-        plt = None
+    plt = _import_plt() if args.plots else None
 
     if plt:
         fig, ax = plt.subplots(figsize=(10, 4))
@@ -147,9 +245,10 @@ def main():
         fig.savefig(OUT_DIR / "wildchat_dow_hist.png", dpi=150)
         plt.close()
 
-        conv_per_day = df.groupby("date").size()
+        day_idx = ts_sec // 86400
+        conv_per_day = np.bincount(day_idx - day_idx.min())  # one entry per calendar day, empty days included
         fig, ax = plt.subplots(figsize=(12, 4))
-        ax.plot(range(len(conv_per_day)), conv_per_day.values, linewidth=0.8)
+        ax.plot(range(len(conv_per_day)), conv_per_day, linewidth=0.8)
         ax.set_xlabel("Day index")
         ax.set_ylabel("Conversations per day")
         ax.set_title("WildChat: conversations per day")
@@ -160,15 +259,16 @@ def main():
     # --- Step 3 — Session Length Distribution ---
     print("\nStep 3 — Session Length Distribution")
     turn = df["turn"]
+    # Sort once; quantiles and tail fractions are then index lookups
+    turn_sorted = np.sort(turn.to_numpy())
+    n_turn = len(turn_sorted)
     stats["turn_mean"] = float(turn.mean())
-    stats["turn_median"] = float(turn.median())
-    stats["turn_p90"] = float(turn.quantile(0.90))
-    stats["turn_p95"] = float(turn.quantile(0.95))
-    stats["turn_p99"] = float(turn.quantile(0.99))
-    stats["frac_ge2"] = float((turn >= 2).mean())
-    stats["frac_ge3"] = float((turn >= 3).mean())
-    stats["frac_ge5"] = float((turn >= 5).mean())
-    stats["frac_ge10"] = float((turn >= 10).mean())
+    stats["turn_median"] = sorted_quantile(turn_sorted, 0.50)
+    stats["turn_p90"] = sorted_quantile(turn_sorted, 0.90)
+    stats["turn_p95"] = sorted_quantile(turn_sorted, 0.95)
+    stats["turn_p99"] = sorted_quantile(turn_sorted, 0.99)
+    for k in (2, 3, 5, 10):
+        stats[f"frac_ge{k}"] = float((n_turn - np.searchsorted(turn_sorted, k, side="left")) / n_turn)
     for k, v in stats.items():
         if k.startswith("turn_") or k.startswith("frac_"):
             print(f"  {k}: {v}")
@@ -181,7 +281,7 @@ def main():
 
     if plt:
         fig, ax = plt.subplots(figsize=(8, 4))
-        max_t = min(int(turn.quantile(0.99)), 50)
+        max_t = min(int(stats["turn_p99"]), 50)
         ax.hist(turn.clip(upper=max_t), bins=range(1, max_t + 2), align="left", edgecolor="black", alpha=0.7)
         ax.set_xlabel("Turn count")
         ax.set_ylabel("Conversations")
@@ -191,7 +291,6 @@ def main():
         plt.close()
 
         # CCDF
-        turn_sorted = np.sort(turn)
         ccdf = 1 - np.arange(1, len(turn_sorted) + 1) / len(turn_sorted)
         fig, ax = plt.subplots(figsize=(6, 5))
         ax.loglog(turn_sorted, ccdf, linewidth=0.8)
@@ -204,7 +303,9 @@ def main():
 
     # --- Step 4 — Arrival Process ---
     print("\nStep 4 — Arrival Process")
-    df = df.sort_values("timestamp_unix").reset_index(drop=True)
+    # df was sorted at build time; only re-sort if Step 2 found otherwise
+    if not stats["strictly_increasing"]:
+        df = df.sort_values("timestamp_unix").reset_index(drop=True)
     inter_arrival = df["timestamp_unix"].diff().dropna()
     inter_arrival = inter_arrival[inter_arrival > 0]
     stats["ia_mean"] = float(inter_arrival.mean())
@@ -215,13 +316,18 @@ def main():
     print(f"  Inter-arrival (s): mean={stats['ia_mean']:.2f}, median={stats['ia_median']:.2f}, p95={stats['ia_p95']:.2f}")
 
     # Arrivals per minute (rolling) and per hour
-    df["bin_1min"] = (df["timestamp_unix"] // 60).astype(int) * 60
-    df["bin_1h"] = (df["timestamp_unix"] // 3600).astype(int) * 3600
-    per_min = df.groupby("bin_1min").size()
-    per_hour = df.groupby("bin_1h").size()
+    # Counts over occupied bins only, like a groupby(...).size() on the bin start
+    bin_min = ts_sec // 60
+    bin_hour = ts_sec // 3600
+    per_min_counts = np.bincount(bin_min - bin_min.min())
+    per_hour_counts = np.bincount(bin_hour - bin_hour.min())
+    per_min = per_min_counts[per_min_counts > 0]
+    hour_idx = np.nonzero(per_hour_counts)[0]
+    per_hour = per_hour_counts[hour_idx]
+    per_hour_start = (hour_idx + bin_hour.min()) * 3600
     stats["arrival_rate_per_min_mean"] = float(per_min.mean())
     stats["arrival_rate_per_hour_mean"] = float(per_hour.mean())
-    stats["arrival_rate_per_hour_std"] = float(per_hour.std())
+    stats["arrival_rate_per_hour_std"] = float(per_hour.std(ddof=1))
 
     if plt:
         fig, ax = plt.subplots(figsize=(8, 4))
@@ -235,7 +341,7 @@ def main():
         plt.close()
 
         fig, ax = plt.subplots(figsize=(12, 4))
-        ax.plot(per_hour.index / 86400, per_hour.values, linewidth=0.5, alpha=0.8)
+        ax.plot(per_hour_start / 86400, per_hour, linewidth=0.5, alpha=0.8)
         ax.set_xlabel("Time (days from start)")
         ax.set_ylabel("Conversations per hour")
         ax.set_title("WildChat: arrival rate (conversations per hour)")
@@ -252,23 +358,17 @@ def main():
     # --- Step 5 — Model-based concurrency (event-based sweep) ---
     print("\nStep 5 — Model-based concurrency")
     for mult, label in [(10, "10s"), (30, "30s")]:
-        df["duration"] = df["turn"] * mult
+        df["duration"] = df["turn"].astype(np.int64) * mult  # int16 would overflow
         df["start_time"] = df["timestamp_unix"] - df["duration"]
-        events = []
-        for _, row in df[["start_time", "timestamp_unix"]].iterrows():
-            s, e = row["start_time"], row["timestamp_unix"]
-            events.append((s, 1))
-            events.append((e + 1e-6, -1))
-        events.sort(key=lambda x: x[0])
-        t_vals = []
-        c_vals = []
-        cur = 0
-        for t, delta in events:
-            cur += delta
-            t_vals.append(t)
-            c_vals.append(cur)
-        t_arr = np.array(t_vals)
-        c_arr = np.array(c_vals)
+        # Interleave (start, +1), (end, -1) per session so the stable sort breaks ties as before
+        n = len(df)
+        t = np.empty(2 * n)
+        t[0::2] = df["start_time"].to_numpy()
+        t[1::2] = df["timestamp_unix"].to_numpy() + 1e-6
+        deltas = np.tile(np.array([1, -1], dtype=np.int32), n)
+        order = np.argsort(t, kind="stable")
+        t_arr = t[order]
+        c_arr = np.cumsum(deltas[order])
         stats[f"concurrency_{label}_peak"] = float(c_arr.max())
         stats[f"concurrency_{label}_mean"] = float(np.mean(c_arr))
         stats[f"concurrency_{label}_median"] = float(np.median(c_arr))
@@ -276,11 +376,10 @@ def main():
 
         if plt:
             # Downsample for plot (events can be huge)
-            n_plot = min(len(t_arr), 8000)
-            idx = np.linspace(0, len(t_arr) - 1, n_plot).astype(int)
+            step = max(1, len(t_arr) // 8000)
             t_min_g = df["start_time"].min()
             fig, ax = plt.subplots(figsize=(12, 4))
-            ax.plot((t_arr[idx] - t_min_g) / 86400, c_arr[idx], linewidth=0.5, alpha=0.8)
+            ax.plot((t_arr[::step] - t_min_g) / 86400, c_arr[::step], linewidth=0.5, alpha=0.8)
             ax.set_xlabel("Time (days from start)")
             ax.set_ylabel("Concurrent sessions")
             ax.set_title(f"WildChat: model-based concurrency (duration = turn × {mult}s)")
@@ -291,7 +390,7 @@ def main():
     # --- Step 6 — Structural (words per turn, by model) ---
     print("\nStep 6 — Structural characteristics")
     stats["avg_words_per_turn_overall"] = float(df["avg_words_per_turn"].mean())
-    by_model = df.groupby("model").agg(
+    by_model = df.groupby("model", observed=True).agg(
         turn_mean=("turn", "mean"),
         turn_median=("turn", "median"),
         count=("conversation_id", "count"),
@@ -303,8 +402,7 @@ def main():
 
     if plt:
         fig, ax = plt.subplots(figsize=(8, 4))
-        for model in df["model"].unique():
-            subset = df[df["model"] == model]["turn"]
+        for model, subset in df.groupby("model", observed=True, sort=False)["turn"]:
             ax.hist(subset.clip(upper=30), bins=range(1, 32), alpha=0.5, label=str(model)[:20], density=True)
         ax.set_xlabel("Turn count")
         ax.set_ylabel("Density")
@@ -314,17 +412,6 @@ def main():
         fig.savefig(OUT_DIR / "wildchat_turn_distribution_by_model.png", dpi=150)
         plt.close()
 
-    def _serialize(v):
-        if isinstance(v, (int, float, str, type(None))):
-            return v
-        if isinstance(v, (np.integer, np.floating)):
-            return float(v) if not np.isnan(v) else None
-        if isinstance(v, (list, tuple)):
-            return [_serialize(x) for x in v]
-        if isinstance(v, dict):
-            return {str(k): _serialize(x) for k, x in v.items()}
-        return str(v)
-
     with open(OUT_DIR / "wildchat_empirical_stats.json", "w") as f:
         json.dump({k: _serialize(v) for k, v in stats.items()}, f, indent=2)
     by_model.to_csv(OUT_DIR / "wildchat_by_model.csv", index=False)
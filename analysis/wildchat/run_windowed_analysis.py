@@ -6,11 +6,16 @@ daily consistency (heatmaps, correlation of daily hourly curves).
 Uses only conversation-level timestamp. No synthetic concurrency.
 """
 
+import argparse
 import os
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from pathlib import Path
 
+from wildchat_common import conversation_words, load_cached_frame, save_cached_frame, timestamp_seconds
+
 BASE = Path(__file__).resolve().parent
 _hf_cache = str(BASE / "hf_cache")
 os.environ["HF_DATASETS_CACHE"] = _hf_cache
@@ -19,67 +24,109 @@ os.environ["HF_HOME"] = _hf_cache
 OUT_DIR = BASE / "output"
 os.makedirs(OUT_DIR, exist_ok=True)
 
+# The only WildChat fields this analysis reads
+SOURCE_COLUMNS = ["timestamp", "turn", "conversation"]
+
+# Per-conversation features, reused across runs while the dataset files are unchanged
+CACHE_DIR = BASE / "cache"
+FEATURES_CACHE = CACHE_DIR / "wildchat_features.parquet"
+FEATURES_META = FEATURES_CACHE.with_suffix(".json")
+
 RESULTS = {}
 
 
+def conversation_features(batch):
+    """Timestamp (unix seconds), turn and context length (total words across utterances) for an Arrow batch."""
+    _, words_sum = conversation_words(batch.column("conversation"))
+    return pa.table({
+        "timestamp_unix": timestamp_seconds(batch.column("timestamp")),
+        "turn": batch.column("turn"),
+        "context_length": words_sum,
+    })
+
+
+def write_csv(frame, path):
+    """Write a DataFrame (without its index) as CSV using Arrow's C++ writer."""
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    pacsv.write_csv(table, str(path), pacsv.WriteOptions(quoting_style="needed"))
+
+
+def mapped_features():
+    """Feature frame from the downloaded train split, via the on-disk cache when it is fresh."""
+    from datasets import load_dataset
+    ds = load_dataset("allenai/WildChat", split="train").select_columns(SOURCE_COLUMNS)
+
+    df = load_cached_frame(ds, FEATURES_CACHE, FEATURES_META)
+    if df is not None:
+        print(f"Using cached features: {FEATURES_CACHE}")
+        return df
+    # One pass over the dataset, fanned out over worker processes: each batch is reduced to three
+    # per-conversation scalars, so the conversation text is never collected in the main process
+    feats = ds.with_format("arrow").map(
+        conversation_features,
+        batched=True,
+        batch_size=1000,
+        num_proc=os.cpu_count(),
+        remove_columns=ds.column_names,
+    )
+    df = feats.to_pandas()
+    save_cached_frame(ds, df, FEATURES_CACHE, FEATURES_META)
+    return df
+
+
+def stream_features():
+    """Feature frame from a streamed train split; only one batch of conversations is held at a time."""
+    from datasets import load_dataset
+    ds = load_dataset("allenai/WildChat", split="train", streaming=True).select_columns(SOURCE_COLUMNS)
+    feats = ds.with_format("arrow").map(
+        conversation_features,
+        batched=True,
+        batch_size=1000,
+        # Keep "turn": an iterable map drops removed columns even when the output redefines them
+        remove_columns=[c for c in ds.column_names if c != "turn"],
+    )
+    return pa.concat_tables(feats.iter(batch_size=1000)).to_pandas()
+
+
 def main():
     global RESULTS
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="stream the train split instead of downloading it (single process, no feature cache)",
+    )
+    args = parser.parse_args()
+
     print("Loading dataset...")
-    from datasets import load_dataset
-    ds = load_dataset("allenai/WildChat", split="train")
-    n_rows = len(ds)
-
-    ts_list = []
-    turn_list = []
-    context_length_list = []  # total word count across all utterances
-
-    for i in range(n_rows):
-        row = ds[i]
-        ts = row["timestamp"]
-        if hasattr(ts, "timestamp"):
-            ts_list.append(ts.timestamp())
-        elif isinstance(ts, (int, float)):
-            ts_list.append(float(ts))
-        else:
-            try:
-                ts_list.append(pd.Timestamp(ts).timestamp())
-            except Exception:
-                ts_list.append(np.nan)
-        turn_list.append(row["turn"])
-        conv = row.get("conversation") or []
-        total_words = sum(len((u.get("content") or "").split()) for u in conv)
-        context_length_list.append(total_words)
-
-    df = pd.DataFrame({
-        "timestamp_unix": ts_list,
-        "turn": turn_list,
-        "context_length": context_length_list,
-    })
+    df = stream_features() if args.streaming else mapped_features()
     df = df.dropna(subset=["timestamp_unix"]).sort_values("timestamp_unix").reset_index(drop=True)
-    df["timestamp_dt"] = pd.to_datetime(df["timestamp_unix"], unit="s", utc=True)
-    df["hour_of_day"] = df["timestamp_dt"].dt.hour
-    df["date"] = df["timestamp_dt"].dt.date
-    df["day_index"] = (df["timestamp_unix"] - df["timestamp_unix"].min()) // 86400
-    df["hour_bin"] = (df["timestamp_unix"] // 3600).astype(int) * 3600
+    # Narrow dtypes for the groupby passes below
+    df = df.astype({"turn": np.int16, "context_length": np.int32})
+    # Calendar keys straight from epoch seconds (UTC); no per-row datetime column
+    hours = (df["timestamp_unix"].to_numpy() // 3600).astype(np.int64)
+    df["hour_of_day"] = (hours % 24).astype(np.int8)
+    df["day_index"] = (hours // 24).astype(np.int32)  # UTC calendar day (days since epoch)
+    df["hour_bin"] = hours * 3600
 
     print("Step 1–2: Global hourly bins and context length")
     # A) Global hourly bins
-    hourly = df.groupby("hour_bin").agg(
+    hourly = df.groupby("hour_bin", sort=False).agg(
         avg_turn=("turn", "mean"),
         avg_context_length=("context_length", "mean"),
         session_count=("turn", "count"),
-    ).reset_index()
+    ).sort_index().reset_index()
     hourly["hour_bin_dt"] = pd.to_datetime(hourly["hour_bin"], unit="s", utc=True)
     hourly["hour_of_day"] = hourly["hour_bin_dt"].dt.hour
 
     # B) Hour-of-day aggregation (mean and std across days for each hour 0–23)
-    by_hod = hourly.groupby("hour_of_day").agg(
+    by_hod = hourly.groupby("hour_of_day", sort=False).agg(
         mean_avg_turn=("avg_turn", "mean"),
         mean_avg_context=("avg_context_length", "mean"),
         std_avg_turn=("avg_turn", "std"),
         std_avg_context=("avg_context_length", "std"),
         n_windows=("hour_bin", "count"),
-    ).reset_index()
+    ).sort_index().reset_index()
 
     print("Step 3: Statistical characterization (hourly windows)")
     at = hourly["avg_turn"]
@@ -99,35 +146,36 @@ def main():
     print(f"  CV_turn = {cv_turn:.4f}, CV_context = {cv_context:.4f}")
 
     print("Step 4: Daily consistency (per day, per hour-of-day)")
-    daily_hourly = df.groupby(["date", "hour_of_day"]).agg(
-        avg_turn=("turn", "mean"),
-        avg_context_length=("context_length", "mean"),
-        session_count=("turn", "count"),
-    ).reset_index()
-    dates = sorted(daily_hourly["date"].unique())
+    # Per (day, hour) means pivoted straight into day x hour matrices: rows = days (sorted), cols = hour 0..23,
+    # NaN where a day has no conversations in that hour
+    daily_hourly = df.pivot_table(
+        index="day_index", columns="hour_of_day", values=["turn", "context_length"], aggfunc="mean"
+    )
+    dates = daily_hourly.index.to_numpy()
     n_days = len(dates)
-    # Build matrix: rows = days, cols = hour 0..23
-    turn_matrix = np.full((n_days, 24), np.nan)
-    context_matrix = np.full((n_days, 24), np.nan)
-    for _, row in daily_hourly.iterrows():
-        d = row["date"]
-        h = int(row["hour_of_day"])
-        i = dates.index(d)
-        turn_matrix[i, h] = row["avg_turn"]
-        context_matrix[i, h] = row["avg_context_length"]
+    date_labels = pd.to_datetime(dates.astype(np.int64) * 86400, unit="s").strftime("%Y-%m-%d")  # heatmap tick labels only
+    turn_matrix = daily_hourly["turn"].reindex(columns=range(24)).to_numpy(dtype=float)
+    context_matrix = daily_hourly["context_length"].reindex(columns=range(24)).to_numpy(dtype=float)
 
     # Pairwise correlation between daily hourly curves (24-dim vectors)
     def vec_corrs(mat):
+        # All day pairs at once: masked sums over the hours both days observed, via matrix products.
+        # Correlation is shift-invariant, so each day is centered first to limit cancellation.
         valid = ~np.isnan(mat)
-        corrs = []
-        for i in range(n_days):
-            for j in range(i + 1, n_days):
-                mask = valid[i] & valid[j]
-                if mask.sum() >= 6:
-                    c = np.corrcoef(mat[i][mask], mat[j][mask])[0, 1]
-                    if not np.isnan(c):
-                        corrs.append(c)
-        return np.array(corrs) if corrs else np.array([np.nan])
+        v = valid.astype(float)
+        x = np.where(valid, mat - np.nanmean(mat, axis=1, keepdims=True), 0.0)
+        n = v @ v.T  # shared hours per pair
+        sx = x @ v.T  # sum of day i over the hours shared with day j
+        sxx = (x * x) @ v.T
+        sxy = x @ x.T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            var = sxx - sx * sx / n
+            var[var <= 1e-12 * sxx] = np.nan  # constant over the shared hours (np.corrcoef gives NaN)
+            r = (sxy - sx * sx.T / n) / np.sqrt(var * var.T)
+        iu = np.triu_indices(len(mat), 1)
+        corrs = np.clip(r[iu], -1, 1)
+        corrs = corrs[(n[iu] >= 6) & ~np.isnan(corrs)]
+        return corrs if len(corrs) else np.array([np.nan])
     turn_corrs = vec_corrs(turn_matrix)
     context_corrs = vec_corrs(context_matrix)
     RESULTS["daily_curve_corr_turn_mean"] = float(np.nanmean(turn_corrs))
@@ -148,82 +196,58 @@ def main():
         plt = None
 
     if plt:
-        # Global hourly: avg_turn over time
-        fig, ax = plt.subplots(figsize=(12, 4))
-        ax.plot(hourly["hour_bin"] / 86400, hourly["avg_turn"], linewidth=0.6, color="C0")
-        ax.set_xlabel("Time (days from start)")
-        ax.set_ylabel("Avg #turns")
-        ax.set_title("WildChat: average turns per conversation by hourly window")
-        ax.grid(True, alpha=0.3)
-        fig.tight_layout()
-        fig.savefig(OUT_DIR / "wildchat_hourly_avg_turns.png", dpi=150)
-        plt.close()
-
-        # Global hourly: avg_context over time
-        fig, ax = plt.subplots(figsize=(12, 4))
-        ax.plot(hourly["hour_bin"] / 86400, hourly["avg_context_length"], linewidth=0.6, color="C1")
-        ax.set_xlabel("Time (days from start)")
-        ax.set_ylabel("Avg context length (words)")
-        ax.set_title("WildChat: average context length by hourly window")
-        ax.grid(True, alpha=0.3)
-        fig.tight_layout()
-        fig.savefig(OUT_DIR / "wildchat_hourly_avg_context.png", dpi=150)
-        plt.close()
-
-        # Hour-of-day: avg_turn (mean across days)
-        fig, ax = plt.subplots(figsize=(10, 4))
-        ax.bar(by_hod["hour_of_day"], by_hod["mean_avg_turn"], yerr=by_hod["std_avg_turn"], capsize=2, color="steelblue", alpha=0.8)
-        ax.set_xlabel("Hour of day (UTC)")
-        ax.set_ylabel("Mean avg #turns (across days)")
-        ax.set_title("WildChat: average turns by hour of day (±1 std across days)")
-        fig.tight_layout()
-        fig.savefig(OUT_DIR / "wildchat_hour_of_day_avg_turns.png", dpi=150)
-        plt.close()
-
-        # Hour-of-day: avg_context
-        fig, ax = plt.subplots(figsize=(10, 4))
-        ax.bar(by_hod["hour_of_day"], by_hod["mean_avg_context"], yerr=by_hod["std_avg_context"], capsize=2, color="darkorange", alpha=0.8)
-        ax.set_xlabel("Hour of day (UTC)")
-        ax.set_ylabel("Mean avg context length (words)")
-        ax.set_title("WildChat: average context length by hour of day (±1 std across days)")
-        fig.tight_layout()
-        fig.savefig(OUT_DIR / "wildchat_hour_of_day_avg_context.png", dpi=150)
-        plt.close()
-
-        # Heatmap: day x hour_of_day, value = avg_turn (y-axis = day index, height capped)
-        fig, ax = plt.subplots(figsize=(12, min(14, max(6, n_days * 0.12))))
-        im = ax.imshow(turn_matrix, aspect="auto", cmap="viridis", vmin=np.nanmin(turn_matrix), vmax=np.nanpercentile(turn_matrix, 95))
-        ax.set_xlabel("Hour of day (UTC)")
-        ax.set_ylabel("Day index")
-        ax.set_xticks(range(0, 24, 2))
-        ax.set_xticklabels(range(0, 24, 2))
+        # Global hourly metrics over time
+        for col, color, ylabel, title, fname in [
+            ("avg_turn", "C0", "Avg #turns", "average turns per conversation by hourly window", "wildchat_hourly_avg_turns.png"),
+            ("avg_context_length", "C1", "Avg context length (words)", "average context length by hourly window", "wildchat_hourly_avg_context.png"),
+        ]:
+            fig, ax = plt.subplots(figsize=(12, 4))
+            ax.plot(hourly["hour_bin"] / 86400, hourly[col], linewidth=0.6, color=color)
+            ax.set_xlabel("Time (days from start)")
+            ax.set_ylabel(ylabel)
+            ax.set_title(f"WildChat: {title}")
+            ax.grid(True, alpha=0.3)
+            fig.tight_layout()
+            fig.savefig(OUT_DIR / fname, dpi=150)
+            plt.close(fig)
+
+        # Hour-of-day: mean across days, ±1 std
+        for metric, color, ylabel, title, fname in [
+            ("turn", "steelblue", "Mean avg #turns (across days)", "average turns", "wildchat_hour_of_day_avg_turns.png"),
+            ("context", "darkorange", "Mean avg context length (words)", "average context length", "wildchat_hour_of_day_avg_context.png"),
+        ]:
+            fig, ax = plt.subplots(figsize=(10, 4))
+            ax.bar(by_hod["hour_of_day"], by_hod[f"mean_avg_{metric}"], yerr=by_hod[f"std_avg_{metric}"], capsize=2, color=color, alpha=0.8)
+            ax.set_xlabel("Hour of day (UTC)")
+            ax.set_ylabel(ylabel)
+            ax.set_title(f"WildChat: {title} by hour of day (±1 std across days)")
+            fig.tight_layout()
+            fig.savefig(OUT_DIR / fname, dpi=150)
+            plt.close(fig)
+
+        # Heatmaps: day x hour_of_day (y-axis = day index, height capped); color range from NaN-aware reductions
         n_yt = min(12, n_days)
         y_ticks = np.linspace(0, n_days - 1, n_yt).astype(int)
-        ax.set_yticks(y_ticks)
-        ax.set_yticklabels([str(dates[i]) for i in y_ticks])
-        plt.colorbar(im, ax=ax, label="Avg #turns")
-        ax.set_title("WildChat: avg turns by day and hour of day")
-        fig.tight_layout()
-        fig.savefig(OUT_DIR / "wildchat_turn_heatmap.png", dpi=150)
-        plt.close()
-
-        # Heatmap: context
-        fig, ax = plt.subplots(figsize=(12, min(14, max(6, n_days * 0.12))))
-        im = ax.imshow(context_matrix, aspect="auto", cmap="plasma", vmin=np.nanmin(context_matrix), vmax=np.nanpercentile(context_matrix, 95))
-        ax.set_xlabel("Hour of day (UTC)")
-        ax.set_ylabel("Day index")
-        ax.set_xticks(range(0, 24, 2))
-        ax.set_xticklabels(range(0, 24, 2))
-        ax.set_yticks(y_ticks)
-        ax.set_yticklabels([str(dates[i]) for i in y_ticks])
-        plt.colorbar(im, ax=ax, label="Avg context length (words)")
-        ax.set_title("WildChat: avg context length by day and hour of day")
-        fig.tight_layout()
-        fig.savefig(OUT_DIR / "wildchat_context_heatmap.png", dpi=150)
-        plt.close()
-
-    hourly.to_csv(OUT_DIR / "wildchat_hourly_windows.csv", index=False)
-    by_hod.to_csv(OUT_DIR / "wildchat_hour_of_day.csv", index=False)
+        for matrix, cmap, label, title, fname in [
+            (turn_matrix, "viridis", "Avg #turns", "avg turns", "wildchat_turn_heatmap.png"),
+            (context_matrix, "plasma", "Avg context length (words)", "avg context length", "wildchat_context_heatmap.png"),
+        ]:
+            fig, ax = plt.subplots(figsize=(12, min(14, max(6, n_days * 0.12))))
+            im = ax.imshow(matrix, aspect="auto", cmap=cmap, vmin=np.nanmin(matrix), vmax=np.nanpercentile(matrix, 95))
+            ax.set_xlabel("Hour of day (UTC)")
+            ax.set_ylabel("Day index")
+            ax.set_xticks(range(0, 24, 2))
+            ax.set_xticklabels(range(0, 24, 2))
+            ax.set_yticks(y_ticks)
+            ax.set_yticklabels([date_labels[i] for i in y_ticks])
+            plt.colorbar(im, ax=ax, label=label)
+            ax.set_title(f"WildChat: {title} by day and hour of day")
+            fig.tight_layout()
+            fig.savefig(OUT_DIR / fname, dpi=150)
+            plt.close(fig)
+
+    write_csv(hourly, OUT_DIR / "wildchat_hourly_windows.csv")
+    write_csv(by_hod, OUT_DIR / "wildchat_hour_of_day.csv")
     write_report(RESULTS, by_hod, hourly, turn_corrs, context_corrs)
     print("Done. Report: wildchat_windowed_phase_analysis.md")
     return RESULTS
@@ -0,0 +1,59 @@
+"""
+Shared Arrow helpers for the WildChat scripts (run_empirical_analysis.py, run_windowed_analysis.py):
+timestamp conversion, per-conversation word counts and the on-disk Parquet caches.
+"""
+
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Runs of non-whitespace, with whitespace exactly as str.split() defines it (RE2 syntax):
+# counting matches equals len(content.split())
+WORD_PATTERN = r"[^\t-\r\x1c- \x85\xa0\x{1680}\x{2000}-\x{200a}\x{2028}\x{2029}\x{202f}\x{205f}\x{3000}]+"
+
+# Arrow timestamp units per second
+TS_UNITS_PER_SEC = {"s": 1, "ms": 10**3, "us": 10**6, "ns": 10**9}
+
+
+def timestamp_seconds(col):
+    """Unix seconds (float64, NaN for missing) from an Arrow timestamp column, dispatching on its type once."""
+    if pa.types.is_timestamp(col.type):
+        secs = pc.divide(col.cast(pa.int64()).cast(pa.float64()), float(TS_UNITS_PER_SEC[col.type.unit]))
+        return secs.to_numpy(zero_copy_only=False)
+    if pa.types.is_integer(col.type) or pa.types.is_floating(col.type):
+        return col.cast(pa.float64()).to_numpy(zero_copy_only=False)
+    ts_dt = pd.to_datetime(col.to_pandas(), utc=True, errors="coerce")
+    return ((ts_dt - pd.Timestamp(0, tz="UTC")) / pd.Timedelta(seconds=1)).to_numpy()  # NaT -> NaN
+
+
+def conversation_words(conv):
+    """(#utterances, total words) per conversation from an Arrow list<struct> column; text never leaves Arrow."""
+    conv_len = pc.list_value_length(conv).fill_null(0).to_numpy(zero_copy_only=False)
+    # Words per utterance in C++; missing content counts as 0 words
+    contents = pc.struct_field(pc.list_flatten(conv), "content")
+    flat_words = pc.count_substring_regex(contents, WORD_PATTERN).fill_null(0).to_numpy(zero_copy_only=False)
+    # Per-conversation totals from prefix sums at the list offsets (empty conversations give 0)
+    offsets = np.concatenate(([0], np.cumsum(conv_len)))
+    words_csum = np.concatenate(([0], np.cumsum(flat_words, dtype=np.int64)))
+    return conv_len, words_csum[offsets[1:]] - words_csum[offsets[:-1]]
+
+
+def load_cached_frame(ds, path, meta_path):
+    """Frame cached at path, or None if missing, older than the dataset files, or built from a different dataset."""
+    src_mtime = max((os.path.getmtime(f["filename"]) for f in ds.cache_files), default=None)
+    if src_mtime is None or not path.exists() or os.path.getmtime(path) < src_mtime:
+        return None
+    meta = json.loads(meta_path.read_text()) if meta_path.exists() else {}
+    if meta.get("n_rows") != len(ds) or meta.get("columns") != ds.column_names:
+        return None
+    return pd.read_parquet(path)
+
+
+def save_cached_frame(ds, df, path, meta_path):
+    """Persist df at path plus, in the meta_path sidecar, the dataset shape it was built from."""
+    os.makedirs(path.parent, exist_ok=True)
+    df.to_parquet(path, compression="zstd", index=False)
+    meta_path.write_text(json.dumps({"n_rows": len(ds), "columns": ds.column_names}))